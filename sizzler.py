@@ -4,51 +4,364 @@ Use this when you have multiple instances of `snag` running to avoid excess
 requests to the NG server.
 
 It will cache responses for a given outward or regional request. These are
-lazily updated when required and pruned when unused for a period of time.
+lazily updated when required and pruned when unused for a period of time, or
+when the cache is full.
 """
 
-import datetime
-import sys
-import urllib.error
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from time import sleep
-from urllib import request
+import argparse
+import hashlib
+import http.client
+import itertools
+import json
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, time
+from typing import Callable, NamedTuple, Optional
+
+from snag import ForecastSource, decompose_fw48
+
+
+class CacheEntry(NamedTuple):
+    """
+    A cached response, along with the half hour interval (as an index since
+    the epoch) it was fetched in. Client errors from the NG API are cached
+    too, so that repeated bad requests are answered without going upstream.
+    """
+
+    slot: int
+    body: bytes
+    etag: str
+    status: int = 200
+
+    @classmethod
+    def create(cls, slot: int, body: bytes, status: int = 200) -> "CacheEntry":
+        etag: str = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        return cls(slot, body, etag, status)
+
+
+class ConnectionPool:
+    """
+    Pool of persistent (keep-alive) connections to a single HTTPS host, so
+    refreshes do not pay for a new TCP and TLS handshake each time
+    """
+
+    def __init__(self, host: str, maxsize: int = 8, timeout: float = 10) -> None:
+        self.host: str = host
+        self.timeout: float = timeout
+        self.idle: queue.LifoQueue = queue.LifoQueue(maxsize)
+
+    def request(self, path: str) -> tuple[int, bytes]:
+        """
+        GET a path from the host. If a pooled connection has been closed by the
+        server, the request is sent again on a new connection. Other failures,
+        including timeouts, are raised rather than waited on again.
+        :param path: path (and query) to fetch
+        :return: (status, body) pair
+        """
+        while True:
+            try:
+                conn: http.client.HTTPSConnection = self.idle.get_nowait()
+                reused: bool = True
+            except queue.Empty:
+                conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+                reused = False
+
+            try:
+                conn.request("GET", path)
+                response: http.client.HTTPResponse = conn.getresponse()
+                body: bytes = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                # RemoteDisconnected is a ConnectionResetError
+                if reused and isinstance(e, (ConnectionResetError, BrokenPipeError)):
+                    continue
+                raise
+
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+            return response.status, body
+
+
+class SizzlerServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server which hands requests to a bounded pool of workers,
+    rather than spawning a new thread for every connection. Closing the
+    server drops any queued requests; requests already being handled run
+    to completion, as the pool's workers are joined at interpreter exit
+    """
+
+    def __init__(self, server_address, handler, threads: int = 16) -> None:
+        super().__init__(server_address, handler)
+        self.pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address) -> None:
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
 
 class Sizzler(BaseHTTPRequestHandler):
-    cache: dict[str, tuple[str, bytearray]] = {}
+    # Entries are immutable once stored, and are replaced rather than modified,
+    # so they can be read and their bodies written to clients without locking
+    # or copying. Storing entries and updating their order takes the lock. The
+    # cache is ordered from least to most recently used, and is bounded by
+    # evicting from the front. Entries older than MAX_AGE_SLOTS are swept out
+    # every PRUNE_INTERVAL requests.
+    MAX_ENTRIES: int = 256
+    MAX_AGE_SLOTS: int = 96
+    PRUNE_INTERVAL: int = 64
+    cache: OrderedDict[str, CacheEntry] = OrderedDict()
+    cache_lock: threading.Lock = threading.Lock()
+    request_count: itertools.count = itertools.count()
+    inflight: dict[str, Future] = {}
+    inflight_lock: threading.Lock = threading.Lock()
+    # Updates which have failed, as (time to retry after, last delay) by key,
+    # guarded by inflight_lock. The delay doubles up to MAX_BACKOFF seconds.
+    MAX_BACKOFF: float = 60.0
+    backoff: dict[str, tuple[float, float]] = {}
+    upstream: ConnectionPool = ConnectionPool("api.carbonintensity.org.uk")
+    regionids: frozenset[str] = frozenset(str(i) for i in range(1, 18))
+
+    @staticmethod
+    def time_slot() -> int:
+        """
+        Index of the current half hour interval since the epoch
+        :return: half hour slot index
+        """
+        return int(time()) // 1800
 
     @staticmethod
-    def half_hour_floor(dt: datetime.datetime) -> datetime.datetime:
+    def request_slot(time_from: str) -> Optional[int]:
+        """
+        Index of the half hour interval containing a time given in a request
+        :param time_from: ISO8601 time, taken as UTC if it has no offset
+        :return: half hour slot index, or None if the time could not be parsed
+        """
+        try:
+            dt: datetime = datetime.fromisoformat(time_from.rstrip("Z"))
+        except ValueError:
+            return None
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp()) // 1800
+
+    def store(self, entries: dict[str, CacheEntry]) -> None:
         """
-        Round a datetime down to the last half hour interval
-        :param dt: datetime to round down
-        :return: datetime rounded down
+        Store entries in the cache as the most recently used, then evict the
+        least recently used entries if the cache is over its size limit
+        :param entries: entries to store, by key
+        """
+        with self.cache_lock:
+            for cache_key, entry in entries.items():
+                self.cache[cache_key] = entry
+                self.cache.move_to_end(cache_key)
+            while len(self.cache) > self.MAX_ENTRIES:
+                self.cache.popitem(last=False)
+
+    def touch(self, *cache_keys: str) -> None:
+        """
+        Mark cache entries as the most recently used
+        :param cache_keys: keys of the entries
+        """
+        with self.cache_lock:
+            for cache_key in cache_keys:
+                if cache_key in self.cache:
+                    self.cache.move_to_end(cache_key)
+
+    def prune(self) -> None:
+        """
+        Remove entries which have not been updated for MAX_AGE_SLOTS half hour
+        intervals, as nothing has requested them in that time, and any expired
+        backoffs
+        """
+        oldest: int = self.time_slot() - self.MAX_AGE_SLOTS
+        with self.cache_lock:
+            for cache_key in [k for k, v in self.cache.items() if v.slot < oldest]:
+                del self.cache[cache_key]
+
+        # Backoffs which have expired no longer need to be kept
+        now: float = monotonic()
+        with self.inflight_lock:
+            for flight_key in [k for k, v in self.backoff.items() if v[0] < now]:
+                del self.backoff[flight_key]
+
+    def fetch_ng(self, path: str) -> Optional[tuple[int, bytes]]:
         """
-        mins_mod30: int = dt.minute % 30
-        if mins_mod30 or dt.second or dt.microsecond:
-            dt = dt - datetime.timedelta(
-                minutes=mins_mod30, seconds=dt.second, microseconds=dt.microsecond
+        Fetch a path from the NG API. Failures are not retried here, as that
+        would hold the request's thread while waiting. Instead, refresh backs
+        off further attempts for the same update.
+        :param path: path (and query) to fetch
+        :return: (status, body) pair, or None if the fetch failed
+        """
+        print(path)
+        try:
+            status, body = self.upstream.request(path)
+        except (http.client.HTTPException, OSError) as e:
+            print(f"Fetch from National Grid failed ({e})")
+            return None
+
+        # Client errors (4xx) will not succeed on retry, so are returned to be
+        # cached. Server errors (5xx) may be transient.
+        if status >= 500:
+            print(f"Fetch from National Grid failed ({status})")
+            return None
+        return status, body
+
+    def update_entry(self, cache_key: str, path: str) -> bool:
+        """
+        Update a single cache entry from the NG API. If the fetch fails, any
+        existing entry is left to be served stale.
+        :param cache_key: key of the cache entry to update
+        :param path: path (and query) to fetch
+        :return: True if the entry was updated
+        """
+        response: Optional[tuple[int, bytes]] = self.fetch_ng(path)
+        if response is None:
+            return False
+        status, body = response
+        self.store({cache_key: CacheEntry.create(self.time_slot(), body, status)})
+        return True
+
+    def update_regional(self, time_from: str, cache_key: str) -> bool:
+        """
+        Update the cache entries for every region from a single request for the
+        full regional forecast. Each region's entry is repacked into the same
+        form as the API's response for that region alone. A client error is
+        cached for the requested region only, as the other regions' requests
+        may not have caused it.
+        :param time_from: start time of the forecast, as given in the request
+        :param cache_key: key of the requested region's cache entry
+        :return: True if the entries were updated
+        """
+        response: Optional[tuple[int, bytes]] = self.fetch_ng(
+            f"/regional/intensity/{time_from}/fw48h"
+        )
+        if response is None:
+            return False
+        status, body = response
+        if status >= 400:
+            self.store({cache_key: CacheEntry.create(self.time_slot(), body, status)})
+            return True
+
+        regions: dict[str, dict] = {}
+        try:
+            for timepoint in json.loads(body)["data"]:
+                for region in timepoint["regions"]:
+                    regionid: str = str(region["regionid"])
+                    if regionid not in regions:
+                        regions[regionid] = {
+                            "regionid": region["regionid"],
+                            "dnoregion": region["dnoregion"],
+                            "shortname": region["shortname"],
+                            "data": [],
+                        }
+                    regions[regionid]["data"].append(
+                        {
+                            "from": timepoint["from"],
+                            "to": timepoint["to"],
+                            "intensity": region["intensity"],
+                            "generationmix": region["generationmix"],
+                        }
+                    )
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Unhandled error parsing JSON: {e}")
+            return False
+
+        slot: int = self.time_slot()
+        self.store(
+            {
+                regionid: CacheEntry.create(slot, json.dumps({"data": region}).encode())
+                for regionid, region in regions.items()
+            }
+        )
+        return True
+
+    def decompose(
+        self, cache_key: str, entry: CacheEntry, source: ForecastSource
+    ) -> Optional[CacheEntry]:
+        """
+        Get a cache entry's forecast decomposed into a compact JSON list of
+        [ISO8601, intensity, slot] triples, as used by snag. This is computed
+        once for each update of the entry, rather than by every client.
+        :param cache_key: key of the cache entry to decompose
+        :param entry: the cache entry to decompose
+        :param source: location information type of the entry
+        :return: decomposed entry, or None if the entry could not be parsed
+        """
+        decomposed_key: str = f"{cache_key}/decomposed"
+        decomposed: Optional[CacheEntry] = self.cache.get(decomposed_key)
+        if decomposed is not None and decomposed.slot == entry.slot:
+            return decomposed
+
+        try:
+            timepoints: list[tuple[str, int, int]] = decompose_fw48(
+                json.loads(entry.body), source
             )
-        return dt
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            print(f"Unhandled error parsing JSON: {e}")
+            return None
 
-    def fetch_ng(self) -> bytearray:
-        print(self.path)
-        success: bool = False
-        attempts: int = 0
-        delay: int = 1
-        base_url: str = "https://api.carbonintensity.org.uk"
-        while not success and attempts < 3:
-            attempts += 1
-            try:
-                page = request.urlopen(f"{base_url}{self.path}")
-                success = True
-            except urllib.error.HTTPError:
-                sleep(delay)
-                delay *= 2
-                continue
+        decomposed = CacheEntry.create(
+            entry.slot, json.dumps(timepoints, separators=(",", ":")).encode()
+        )
+        self.store({decomposed_key: decomposed})
+        return decomposed
 
-        return page.read()
+    def refresh(
+        self, flight_key: str, cache_key: str, update: Callable[[], bool]
+    ) -> None:
+        """
+        Update the cache from the NG API. Concurrent requests which need the
+        same update wait on, and share, a single upstream fetch. If an update
+        fails, it is not attempted again until an exponentially increasing
+        delay has passed; until then, requests are served from the cache.
+        :param flight_key: identifies the update being made
+        :param cache_key: key of the requested entry, which the update refreshes
+        :param update: function which fetches and updates the cache, returning
+        True on success
+        """
+        with self.inflight_lock:
+            # A request which found the entry stale may arrive after another
+            # request's update has completed, so check again before fetching
+            entry: Optional[CacheEntry] = self.cache.get(cache_key)
+            if entry is not None and entry.slot == self.time_slot():
+                return
+            if monotonic() < self.backoff.get(flight_key, (0.0, 0.0))[0]:
+                return
+            future: Optional[Future] = self.inflight.get(flight_key)
+            leader: bool = future is None
+            if leader:
+                future = Future()
+                self.inflight[flight_key] = future
+
+        if not leader:
+            future.result()
+            return
+
+        success: bool = False
+        try:
+            success = update()
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.inflight_lock:
+                del self.inflight[flight_key]
+                if success:
+                    self.backoff.pop(flight_key, None)
+                else:
+                    delay: float = self.backoff.get(flight_key, (0.0, 0.5))[1] * 2
+                    delay = min(delay, self.MAX_BACKOFF)
+                    self.backoff[flight_key] = (monotonic() + delay, delay)
 
     def do_GET(self) -> None:
         # Determine the type of request, update the cache if required, then
@@ -57,55 +370,126 @@ class Sizzler(BaseHTTPRequestHandler):
         # 0:    National
         # 1-17  Regional
         # Other Regional by postcode
+        # Any of these can be prefixed with /decomposed to get the forecast as
+        # a list of [ISO8601, intensity, slot] triples instead of the NG API's response
         print(self.path)
-        split_path: list[str] = self.path.split("/")[1:]
-        cache_key: str | None = None
+        path: str = self.path
+        decomposed: bool = path.startswith("/decomposed/")
+        if decomposed:
+            path = path[len("/decomposed") :]
+
+        split_path: list[str] = path.split("/")[1:]
+        cache_key: Optional[str] = None
+        source: ForecastSource = ForecastSource.NATIONAL
         update_reqd: bool = False
-        time_now: datetime.datetime = datetime.datetime.now()
 
-        if "fw48h" in self.path:
+        if "fw48h" in path:
             if len(split_path) != 3:
                 cache_key = split_path[-1]
+                if "/regionid/" in path:
+                    source = ForecastSource.REGIONAL
+                else:
+                    source = ForecastSource.POSTCODE
             else:
                 cache_key = "0"
 
-        # Rounding the last updated time up and the current time down, if these
-        # are not the same, then the forecast needs to be updated. If the key
-        # does not exist, then add to the cache
+        # If the entry was stored in an earlier half hour interval, then the
+        # forecast needs to be updated. If the key does not exist, then add to
+        # the cache
         try:
-            cached_time: str = self.cache[cache_key][0]
-            time_last: datetime.datetime = datetime.datetime.fromisoformat(cached_time)
-            time_last_down: datetime.datetime = self.half_hour_floor(time_last)
-            time_now_down: datetime.datetime = self.half_hour_floor(time_now)
-            if time_last_down != time_now_down:
+            if self.cache[cache_key].slot != self.time_slot():
                 update_reqd = True
         except KeyError:
             update_reqd = True
 
+        # All regions are fetched together, as the NG API returns every region
+        # in a single response. Postcodes must be fetched individually. Only a
+        # request for the current half hour may update every region; any other
+        # start time updates just its own entry.
         if update_reqd and cache_key:
-            self.cache[cache_key] = (time_now.isoformat(), self.fetch_ng())
+            if (
+                source == ForecastSource.REGIONAL
+                and cache_key in self.regionids
+                and self.request_slot(split_path[2]) == self.time_slot()
+            ):
+                self.refresh(
+                    "regional",
+                    cache_key,
+                    lambda: self.update_regional(split_path[2], cache_key),
+                )
+            else:
+                self.refresh(
+                    cache_key, cache_key, lambda: self.update_entry(cache_key, path)
+                )
 
-        self.send_response(200)
-        self.end_headers()
+        if not cache_key:
+            body: bytes = b"Unknown GET request"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
 
-        if cache_key:
-            self.wfile.write(self.cache[cache_key][1])
+        entry: Optional[CacheEntry] = self.cache.get(cache_key)
+        if entry is not None and entry.status == 200 and decomposed:
+            entry = self.decompose(cache_key, entry, source)
+            self.touch(cache_key, f"{cache_key}/decomposed")
         else:
-            self.wfile.write(b"Unknown GET request")
+            self.touch(cache_key)
+
+        if next(self.request_count) % self.PRUNE_INTERVAL == 0:
+            self.prune()
+
+        if entry is None:
+            self.send_error(502, "Fetch from National Grid failed")
+            return
+
+        # Clients may cache the response until the end of the half hour, and
+        # revalidate it afterwards with the ETag
+        max_age: int = max(0, (entry.slot + 1) * 1800 - int(time()))
+        etags: list[str] = [
+            etag.strip() for etag in self.headers.get("If-None-Match", "").split(",")
+        ]
+        if entry.status == 200 and (entry.etag in etags or "*" in etags):
+            self.send_response(304)
+            self.send_header("ETag", entry.etag)
+            self.send_header("Cache-Control", f"max-age={max_age}")
+            self.end_headers()
+            return
+
+        self.send_response(entry.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(entry.body)))
+        self.send_header("ETag", entry.etag)
+        self.send_header("Cache-Control", f"max-age={max_age}")
+        self.end_headers()
+        self.wfile.write(entry.body)
 
 
 def main() -> None:
-    port: int = 8080
-    try:
-        port = int(sys.argv[2])
-    except IndexError:  # no port specified, use default
-        pass
-    except ValueError as e:
-        print(f"Could not convert argument to int: {e}")
+    parser = argparse.ArgumentParser(
+        prog="sizzler",
+        description="Caching mirror for the National Grid Carbon Intensity API.",
+    )
+    parser.add_argument(
+        "port", nargs="?", default=8080, type=int, help="Port to serve on."
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default=16,
+        type=int,
+        help="Maximum number of requests handled concurrently.",
+    )
+    args = parser.parse_args()
+
+    if args.threads < 1:
+        print("Number of threads must be at least 1")
         exit(1)
 
-    print(f"Starting sizzler on port {port}")
-    server = HTTPServer(("localhost", port), Sizzler)
+    print(f"Starting sizzler on port {args.port} ({args.threads} threads)")
+    server = SizzlerServer(("localhost", args.port), Sizzler, args.threads)
 
     try:
         server.serve_forever()
@@ -1,20 +1,39 @@
 import argparse
+import asyncio
 import configparser
+import http.client
+import itertools
 import json
 import math
+import operator
 import os
 import shlex
 import subprocess
 import sys
+import threading
 import time
-import urllib.error
-from dataclasses import dataclass
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
 from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
 from socket import timeout
-from typing import Dict, List, Tuple
-from urllib import request
+from typing import Dict, List, Optional, Tuple, Union
+
+# Origin for numbering 30 minute intervals, see half_hour_slot
+EPOCH: datetime = datetime(1970, 1, 1)
+
+# Persistent connections, keyed by "scheme://host", reused between fetches
+connections: Dict[str, http.client.HTTPConnection] = {}
+
+# Half hour slot, last ETag, and parsed JSON for each URL, used to revalidate
+# repeat fetches. URLs include the forecast's start time, so entries from
+# earlier slots will not be fetched again and are dropped.
+validators: Dict[str, Tuple[int, str, Union[Dict, List]]] = {}
+
+# Held by query_api while it uses the connections and validators
+fetch_lock: threading.Lock = threading.Lock()
 
 
 class ForecastSource(Enum):
@@ -37,9 +56,10 @@ class SnagTask:
     co2_worst_known: int = 0
     co2_worst_forecast: int = 0
     duration_scheduled: int = 10
-    duration_actual: datetime = 0
+    duration_actual: timedelta = timedelta(0)
     has_run: bool = False
     base_host: str = "https://api.carbonintensity.org.uk"
+    sizzler: bool = False
     tolerance: int = 5
     time_offset: int = 0
     shell: bool = False
@@ -55,73 +75,186 @@ class SnagTask:
         self.due_by = due_by_dt.strftime("%Y-%m-%dT%H:%M")
 
 
-def query_api(url: str, verbose: bool = False) -> Dict:
+@dataclass(frozen=True)
+class SnagConfig:
     """
-    Send a query to National Grid API and return the JSON representation
-    :param url: full string to fetch from
-    :return: JSON return
+    snag's options, loaded once from the configuration file with any command
+    line overrides applied
     """
-    RETRIES = 3
-    success: bool = False
-    attempts: int = 0
-    delay: int = 1
 
-    while not success and attempts < RETRIES:
-        if verbose:
-            print(f"    Fetching: {url} ... ", end="")
+    delay: int = 0
+    base_host: str = "https://api.carbonintensity.org.uk"
+    sizzler: bool = False
+    tolerance: int = 5
+    outward_code: str = "0"
+    verbose: bool = False
+    echo_out: bool = False
+
+    @classmethod
+    def load(
+        cls, section: configparser.SectionProxy, args: argparse.Namespace
+    ) -> "SnagConfig":
+        """
+        Build the configuration from the file's SNAG section. Arguments given on
+        the command line take precedence, and missing keys take the defaults.
+        An invalid value is reported, and snag exits.
+        :param section: SNAG section of the configuration file
+        :param args: parsed command line arguments
+        :return: SnagConfig object
+        """
+        values: Dict[str, Union[int, str, bool]] = {}
+        for field in fields(cls):
+            arg = getattr(args, field.name)
+            try:
+                if field.type is bool:
+                    values[field.name] = arg or section.getboolean(
+                        field.name, field.default
+                    )
+                elif field.type is int:
+                    values[field.name] = int(
+                        arg or section.get(field.name, field.default)
+                    )
+                else:
+                    values[field.name] = arg or section.get(field.name, field.default)
+            except ValueError as e:
+                print(f"Invalid {field.name} in configuration: {e}")
+                exit(1)
+
+        return cls(**values)
+
+
+def fetch(
+    url: str, headers: Optional[Dict[str, str]] = None
+) -> Tuple[http.client.HTTPResponse, bytes]:
+    """
+    GET a URL over a persistent connection to its host. If a reused connection
+    has been closed by the server, the request is sent again on a new one.
+    :param url: full string to fetch from
+    :param headers: additional request headers
+    :return: (response, body) pair
+    """
+    parts = urllib.parse.urlsplit(url)
+    host: str = f"{parts.scheme}://{parts.netloc}"
+    path: str = f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+    conn: Optional[http.client.HTTPConnection] = connections.get(host)
+    if conn is None:
+        if parts.scheme == "https":
+            conn = http.client.HTTPSConnection(parts.netloc, timeout=10)
+        else:
+            conn = http.client.HTTPConnection(parts.netloc, timeout=10)
+        connections[host] = conn
 
-        attempts += 1
+    while True:
+        reused: bool = conn.sock is not None
         try:
-            page = request.urlopen(url, timeout=10)
-            if verbose:
-                print("Done!")
-            success = True
-        except urllib.error.HTTPError as e:
+            conn.request("GET", path, headers=headers or {})
+            page = conn.getresponse()
+            return page, page.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            if not reused or isinstance(e, timeout):
+                raise
+
+
+def query_api(url: str, verbose: bool = False) -> Union[Dict, List]:
+    """
+    Send a query to National Grid API and return the JSON representation
+    :param url: full string to fetch from
+    :return: JSON return
+    """
+    # Tasks may be scheduled from several threads, and connections must not
+    # be shared between them. Serialising fetches also lets a fetch of a URL
+    # that another task has just fetched be revalidated rather than repeated.
+    with fetch_lock:
+        RETRIES = 3
+        success: bool = False
+        attempts: int = 0
+        delay: int = 1
+
+        # If this URL has been fetched before, only ask for the body if it has
+        # changed since
+        headers: Dict[str, str] = {}
+        if url in validators:
+            headers["If-None-Match"] = validators[url][1]
+
+        while not success and attempts < RETRIES:
             if verbose:
-                print(
-                    f"    Fetch from National Grid failed ({e}). Retrying in {delay} s"
-                )
-            time.sleep(delay)
-            delay *= 2
-            continue
-        except urllib.error.URLError as e:
-            if isinstance(e.reason, timeout):
+                print(f"    Fetching: {url} ... ", end="")
+
+            attempts += 1
+            try:
+                page, data = fetch(url, headers)
+            except timeout as e:
                 print(
                     f"    Fetch from National Grid timed out ({e}). Retrying in {delay} s"
                 )
-            else:
+                time.sleep(delay)
+                delay *= 2
+                continue
+            except (http.client.HTTPException, OSError) as e:
                 print(
                     f"    Fetch from National Grid failed ({e}). Retrying in {delay} s"
                 )
-            time.sleep(delay)
-            delay *= 2
-            continue
+                time.sleep(delay)
+                delay *= 2
+                continue
+
+            if page.status == 304 and url in validators:
+                if verbose:
+                    print("Not modified")
+                return validators[url][2]
+
+            if page.status != 200:
+                if verbose:
+                    print(
+                        f"    Fetch from National Grid failed ({page.status} {page.reason}). Retrying in {delay} s"
+                    )
+                time.sleep(delay)
+                delay *= 2
+                continue
 
-    if not success:
-        print("Fetch from National Grid failed. Exiting.")
-        exit(1)
+            if verbose:
+                print("Done!")
+            success = True
 
-    try:
-        data = page.read()
-        encoding = page.info().get_content_charset("utf-8")
-        return_json: Dict = json.loads(data.decode(encoding))
-    except Exception as e:
-        print(f"Unhandled error parsing JSON: {e}")
-        exit(1)
+        if not success:
+            print("Fetch from National Grid failed. Exiting.")
+            exit(1)
+
+        try:
+            # json parses UTF-8 bytes directly, avoiding a decoded copy of the body
+            encoding = page.headers.get_content_charset("utf-8")
+            if encoding.lower() not in ("utf-8", "utf8"):
+                data = data.decode(encoding)
+            return_json: Union[Dict, List] = json.loads(data)
+        except Exception as e:
+            print(f"Unhandled error parsing JSON: {e}")
+            exit(1)
+
+        etag: Optional[str] = page.headers.get("ETag")
+        if etag:
+            slot: int = half_hour_slot(datetime.now())
+            for stale_url in [k for k, v in validators.items() if v[0] < slot]:
+                del validators[stale_url]
+            validators[url] = (slot, etag, return_json)
 
-    return return_json
+        return return_json
 
 
-def decompose_fw48(data: Dict, forecast_type: ForecastSource) -> List[Tuple[str, int]]:
+def decompose_fw48(
+    data: Dict, forecast_type: ForecastSource
+) -> List[Tuple[str, int, int]]:
     """
-    Decompose a 48 hour forecast into a list of (ISO8601, intensity) pairs.
+    Decompose a 48 hour forecast into a list of (ISO8601, intensity, slot)
+    triples, where slot is the index of the time's 30 minute interval.
     Datastructure dependent on source (National, (Regional | Postcode))
     :param data: JSON from NG API
     :param forecast_type: location information type
     :param verbose: verbose output
-    :return: (ISO8601, int) time and intensity pairs
+    :return: (ISO8601, int, int) time, intensity, and slot triples
     """
-    ret_list: List[Tuple[str, int]] = []
+    ret_list: List[Tuple[str, int, int]] = []
 
     if forecast_type != ForecastSource.NATIONAL:
         extract = data["data"]["data"]
@@ -138,7 +271,7 @@ def decompose_fw48(data: Dict, forecast_type: ForecastSource) -> List[Tuple[str,
     for timepoint in extract:
         dt: str = timepoint["from"].rstrip("Z")
         intensity: int = int(timepoint["intensity"]["forecast"])
-        ret_list.append((dt, intensity))
+        ret_list.append((dt, intensity, half_hour_slot(datetime.fromisoformat(dt))))
 
     return ret_list
 
@@ -149,12 +282,20 @@ def half_hour_floor(dt: datetime) -> datetime:
     :param dt: datetime object to round
     :return: datetime rounded down to nearest 30 min
     """
-    minute_mod30: int = dt.minute % 30
-    if minute_mod30 or dt.second or dt.microsecond:
-        dt = dt - timedelta(
-            minutes=minute_mod30, seconds=dt.second, microseconds=dt.microsecond
-        )
-    return dt
+    return datetime(
+        dt.year, dt.month, dt.day, dt.hour, dt.minute - dt.minute % 30, tzinfo=dt.tzinfo
+    )
+
+
+def half_hour_slot(dt: datetime) -> int:
+    """
+    Index of the 30 minute interval containing a datetime object, counted from
+    1970-01-01T00:00. Comparing indices is equivalent to comparing the floored
+    datetimes.
+    :param dt: datetime object to index
+    :return: index of 30 minute interval
+    """
+    return (dt - EPOCH) // timedelta(minutes=30)
 
 
 def half_hour_ceil(dt: datetime) -> datetime:
@@ -180,7 +321,9 @@ def run_task(task: SnagTask, verbose: bool = False) -> None:
         print(f"    Running task: {task.cmd}")
         cmd: List[str] = shlex.split(task.cmd)
 
-    start: datetime = datetime.now()
+    # Time with the monotonic clock, so the duration is not affected by
+    # changes to the wall clock while the task runs
+    start: float = time.monotonic()
     try:
         p = subprocess.run(
             cmd,
@@ -194,14 +337,14 @@ def run_task(task: SnagTask, verbose: bool = False) -> None:
         print(f"Command {task.cmd} not found!")
         exit(1)
 
-    task.duration_actual = datetime.now() - start
+    task.duration_actual = timedelta(seconds=time.monotonic() - start)
     task.has_run = True
 
     if task.echo_out:
         print(p.stdout)
 
 
-def weight_timepoints(task: SnagTask, timepoints: List[Tuple[str, int]]) -> None:
+def weight_timepoints(task: SnagTask, timepoints: List[Tuple[str, int, int]]) -> None:
     """
     Weight the timepoints for intensity for a given task duration and offset
     :param task: the SnagTask object, this contains the needed task data
@@ -228,13 +371,27 @@ def weight_timepoints(task: SnagTask, timepoints: List[Tuple[str, int]]) -> None
 
     # Use this window to  scale the raw time point information. This will
     # implicitly shrink the timepoints list (overflow at the end), but values
-    # here will not be used anyway as the task must have started before that
-    for idx in range(len(timepoints) - len(window)):
-        weighted_avg: int = sum(
-            [a * b[1] for a, b in zip(window, timepoints[idx : (idx + len(window))])]
+    # here will not be used anyway as the task must have started before that.
+    # Each timepoint's weighted sum is accumulated one window segment at a
+    # time: every segment's weight multiplies the intensities in a single
+    # pass, run in C through map/operator, rather than slicing the
+    # intensities for every timepoint. The window's sum is only computed once.
+    intensities: List[int] = [tp[1] for tp in timepoints]
+    count: int = len(timepoints) - len(window)
+    weighted: List[int] = [0] * count
+    for offset, weight in enumerate(window):
+        weighted = list(
+            map(
+                operator.add,
+                weighted,
+                map(weight.__mul__, itertools.islice(intensities, offset, None)),
+            )
         )
-        weighted_avg = int(weighted_avg / sum(window))
-        timepoints[idx] = (timepoints[idx][0], weighted_avg)
+
+    window_sum: int = sum(window)
+    for idx, weighted_sum in enumerate(weighted):
+        tm_str, _, slot = timepoints[idx]
+        timepoints[idx] = (tm_str, weighted_sum // window_sum, slot)
 
 
 def schedule_task(task: SnagTask, first: bool = False, verbose: bool = False) -> None:
@@ -252,6 +409,7 @@ def schedule_task(task: SnagTask, first: bool = False, verbose: bool = False) ->
     # 1-17: regional, other: outward code
     time_now: datetime = datetime.now()
     time_now_floor: str = half_hour_floor(time_now).isoformat()
+    base_host: str = task.base_host
     get_dest: str = ""
     forecast_type: ForecastSource = ForecastSource.NATIONAL
 
@@ -260,24 +418,35 @@ def schedule_task(task: SnagTask, first: bool = False, verbose: bool = False) ->
         print(f"    Time now       : {time_now.strftime('%Y-%m-%d %H:%M')}")
         print(f"    Due by         : {' '.join(task.due_by.split('T'))}")
 
+    # sizzler can decompose the forecast itself, and share the result between
+    # all of its clients
+    if task.sizzler:
+        base_host = f"{base_host}/decomposed"
+
     try:
         numeric: int = int(task.outward_code)
         if numeric == 0:
-            get_dest = f"{task.base_host}/intensity/{time_now_floor}Z/fw48h"
+            get_dest = f"{base_host}/intensity/{time_now_floor}Z/fw48h"
             pass  # This is the default national ID
         elif 0 < numeric < 18:
-            get_dest = f"{task.base_host}/regional/intensity/{time_now_floor}Z/fw48h/regionid/{numeric}"
+            get_dest = f"{base_host}/regional/intensity/{time_now_floor}Z/fw48h/regionid/{numeric}"
             forecast_type = ForecastSource.REGIONAL
         else:
             print("Region code must be between 1 and 17")
             exit(1)
     except ValueError:  # Postcode
-        get_dest = f"{task.base_host}/regional/intensity/{time_now_floor}Z/fw48h/postcode/{task.outward_code}"
+        get_dest = f"{base_host}/regional/intensity/{time_now_floor}Z/fw48h/postcode/{task.outward_code}"
         forecast_type = ForecastSource.POSTCODE
 
     # Fetch from the NG API, decompose into list of (time, intensity) points
-    ng_data: Dict = query_api(get_dest, verbose)
-    timepoints: List[Tuple[str, int]] = decompose_fw48(ng_data, forecast_type)
+    if task.sizzler:
+        timepoints: List[Tuple[str, int, int]] = [
+            (tm_str, intensity, slot)
+            for tm_str, intensity, slot in query_api(get_dest, verbose)
+        ]
+    else:
+        ng_data: Dict = query_api(get_dest, verbose)
+        timepoints = decompose_fw48(ng_data, forecast_type)
 
     # If the task will cross a 30 minute boundary, then calculate the weighted
     # mean intensity over that time period.
@@ -291,7 +460,7 @@ def schedule_task(task: SnagTask, first: bool = False, verbose: bool = False) ->
     # CO2 intensity, accounting for intensity tolerance. On first call, capture
     # the CO2 intensity (spot saving), then known (known worst), and forecast
     tp_now: str = timepoints[0][0]
-    tp_lowest: Tuple[str, int] = timepoints[0]
+    tp_lowest: Tuple[str, int, int] = timepoints[0]
     intensity_now: int = tp_lowest[1]
 
     if first:
@@ -301,15 +470,20 @@ def schedule_task(task: SnagTask, first: bool = False, verbose: bool = False) ->
         task.co2_worst_known = intensity_now
 
     intensity_highest: int = task.co2_worst_forecast
-    due_by_dt: datetime = datetime.fromisoformat(task.due_by)
-    for tm_str, intensity in timepoints:
-        tm_dt: datetime = datetime.fromisoformat(tm_str)
-        if tm_dt > due_by_dt:
+    # Timepoints are on 30 minute boundaries, so one is after the due by time
+    # exactly when its slot is after the due by time's slot
+    due_slot: int = half_hour_slot(datetime.fromisoformat(task.due_by))
+    # The scaled lowest intensity only changes with the lowest timepoint, so
+    # is only recalculated then
+    tolerance_factor: float = 1 - task.tolerance / 100
+    lowest_scaled: int = int(tp_lowest[1] * tolerance_factor)
+    for tm_str, intensity, tp_slot in timepoints:
+        if tp_slot > due_slot:
             break
 
-        lowest_scaled: int = int(tp_lowest[1] * (1 - task.tolerance / 100))
         if intensity < lowest_scaled:
-            tp_lowest = (tm_str, intensity)
+            tp_lowest = (tm_str, intensity, tp_slot)
+            lowest_scaled = int(intensity * tolerance_factor)
 
         if intensity > intensity_highest:
             intensity_highest = intensity
@@ -334,17 +508,159 @@ def sleep_until_next(offset: int = 0, verbose: bool = False) -> None:
     :param offset: offset (in minutes) from 30 minute interval
     :param verbose: verbose output
     """
+    time.sleep(time_until_next(offset, verbose))
+
+
+def time_until_next(offset: int = 0, verbose: bool = False) -> float:
+    """
+    Time until the next 30 minute interval
+    :param offset: offset (in minutes) from 30 minute interval
+    :param verbose: verbose output
+    :return: seconds until the next interval
+    """
     next_wake: datetime = half_hour_ceil(datetime.now())
     # Add an additional 1 s to account for residual microseconds
     next_wake = next_wake + timedelta(minutes=offset, seconds=1)
-    sleep_time: timedelta = next_wake - datetime.now()
+    # timedelta.seconds excludes the days component, which is -1 for a
+    # negative interval, so use the total and never sleep for less than 0 s
+    sleep_time: float = max(0.0, (next_wake - datetime.now()).total_seconds())
     if verbose:
         wake_time: str = next_wake.strftime("%Y-%m-%d %H:%M")
-        print(
-            f"    Sleeping until : {wake_time} ({int(sleep_time.seconds / 60)}m{sleep_time.seconds % 60}s)"
+        mins, secs = divmod(int(sleep_time), 60)
+        print(f"    Sleeping until : {wake_time} ({mins}m{secs}s)")
+
+    return sleep_time
+
+
+async def schedule_task_async(
+    task: SnagTask, executor: ThreadPoolExecutor, verbose: bool = False
+) -> bool:
+    """
+    Schedule a task until it has run, and report it. Fetching and running are
+    blocking, so are done in an executor with a thread for each task, allowing
+    many tasks to be scheduled from one process without a running task holding
+    up the others. A task which fails is reported, and does not stop the rest.
+    :param task: SnagTask dataclass with all information required
+    :param executor: executor to fetch and run the task in
+    :param verbose: verbosity flag to stdout
+    :return: True if the task ran
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(executor, schedule_task, task, True, verbose)
+
+        while not task.has_run:
+            await asyncio.sleep(time_until_next(task.time_offset, verbose))
+            await loop.run_in_executor(executor, schedule_task, task, False, verbose)
+    except SystemExit:
+        # Fetching and running exit on failure, which would end every task
+        print(f"snag: task {task.cmd} failed")
+        return False
+
+    report(task)
+    return True
+
+
+async def schedule_tasks(tasks: List[SnagTask], verbose: bool = False) -> bool:
+    """
+    Schedule several tasks concurrently
+    :param tasks: SnagTask dataclasses to schedule
+    :param verbose: verbosity flag to stdout
+    :return: True if every task ran
+    """
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        results: List[bool] = await asyncio.gather(
+            *[schedule_task_async(task, executor, verbose) for task in tasks]
         )
+    return all(results)
+
+
+def parse_due_by(due_by: str) -> str:
+    """
+    If the due_by argument has been given as a numeric value, then convert to
+    an ISO8601 format time ahead of now. Otherwise, strip trailing Z if present
+    as datetime.isoformat does not handle it correctly.
+    :param due_by: ISO8601 time, or hours ahead of now
+    :return: ISO8601 time
+    """
+    try:
+        time_ahead: float = float(due_by)
+        return (datetime.now() + timedelta(hours=time_ahead)).isoformat()
+    except ValueError:
+        return due_by.rstrip("Z")
+
+
+def load_tasks(path: str, cfg: SnagConfig) -> List[SnagTask]:
+    """
+    Load tasks from a file with a [TASK_x] section for each task. Each section
+    must have cmd and due_by keys. The optional keys are duration, delay,
+    outward_code, tolerance, working_dir, shell, and echo_out; those which
+    are global options default to the global configuration.
+    :param path: path of the tasks file
+    :param cfg: global configuration
+    :return: list of SnagTask objects
+    """
+    tasks_cfg: configparser.ConfigParser = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(path) as f:
+            tasks_cfg.read_file(f)
+    except (OSError, configparser.Error) as e:
+        print(f"Failed to read tasks file {path}: {e}")
+        exit(1)
+
+    tasks: List[SnagTask] = []
+    for name in tasks_cfg.sections():
+        if not name.startswith("TASK"):
+            continue
+
+        section: configparser.SectionProxy = tasks_cfg[name]
+        try:
+            tasks.append(
+                SnagTask(
+                    cmd=section["cmd"],
+                    due_by=parse_due_by(section["due_by"]),
+                    duration_scheduled=math.ceil(section.getfloat("duration", 10)),
+                    base_host=cfg.base_host,
+                    sizzler=cfg.sizzler,
+                    outward_code=section.get("outward_code", cfg.outward_code),
+                    time_offset=section.getint("delay", cfg.delay),
+                    tolerance=section.getint("tolerance", cfg.tolerance),
+                    working_dir=section.get("working_dir", "./"),
+                    shell=section.getboolean("shell", False),
+                    echo_out=section.getboolean("echo_out", cfg.echo_out),
+                )
+            )
+        except (KeyError, ValueError) as e:
+            print(f"Invalid task {name} in {path}: {e}")
+            exit(1)
+
+    if not tasks:
+        print(f"No tasks found in {path}")
+        exit(1)
 
-    time.sleep(sleep_time.seconds)
+    return tasks
+
+
+def report(task: SnagTask) -> None:
+    """
+    Report the carbon saving of a task which has run
+    :param task: SnagTask object which has run
+    """
+    time_now: str = datetime.now().strftime("%Y-%m-%d %H:%M")
+    savings: List[int] = [0] * 3
+
+    for saving, intensity in enumerate(
+        [task.co2_spot, task.co2_worst_known, task.co2_worst_forecast]
+    ):
+        savings[saving] = abs(int(((task.co2_actual / intensity) - 1) * 100))
+
+    print(f"snag @ {time_now}")
+    print(f"    Task:         {task.cmd}")
+    print(f"    Duration:     {task.duration_actual} @ {task.co2_actual} gCO2/kWh")
+    print("    CO2 saving:")
+    print(f"      - Spot:     {savings[0]}%")
+    print(f"      - Known:    {savings[1]}%")
+    print(f"      - Forecast: {savings[2]}%")
 
 
 def main():
@@ -383,6 +699,11 @@ def main():
         action="store_true",
         help="Print the task's stdout/stderr to stdout when complete.",
     )
+    parser.add_argument(
+        "-f",
+        "--tasks",
+        help="Path to a file of tasks to schedule together, instead of a single task.",
+    )
     parser.add_argument(
         "-l", "--duration", default=10, type=float, help="Task's duration in minutes."
     )
@@ -401,8 +722,12 @@ def main():
         "-t", "--tolerance", help="Minimum gCO2/kWh saving to reschedule (%%)."
     )
     parser.add_argument(
-        "-v", "--verbose", action="store_const", const="yes", help="Verbose output."
+        "-z",
+        "--sizzler",
+        action="store_true",
+        help="The base host is a sizzler mirror, fetch the decomposed forecast from it.",
     )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output.")
     parser.add_argument(
         "-w",
         "--working_dir",
@@ -421,14 +746,17 @@ def main():
                                  Written by Angus Logan, for Bear and Moose.",
     )
 
-    # Required arguments
+    # Required arguments, unless a tasks file is given
     parser.add_argument(
         "due_by",
+        nargs="?",
         help="Time the task is due by. This can be in ISO8601 format (YYYY-MM-DDTHH:MMZ), or the number of hours ahead of the current time.",
     )
-    parser.add_argument("cmd", nargs="+", help="The command to be run.")
+    parser.add_argument("cmd", nargs="*", help="The command to be run.")
 
     args = parser.parse_args()
+    if not args.tasks and not (args.due_by and args.cmd):
+        parser.error("the following arguments are required: due_by, cmd")
 
     # Load configuration from file, and then override with arguments. If the
     # config file does not exist, then create with default values
@@ -443,6 +771,7 @@ def main():
         config["SNAG"] = {
             "delay": "0",
             "base_host": "https://api.carbonintensity.org.uk",
+            "sizzler": "no",
             "tolerance": "5",
             "outward_code": "0",
             "verbose": "no",
@@ -460,67 +789,37 @@ def main():
             print(f"Failed to create configuration file {args.cfg}: {e}")
             exit(1)
 
-    if args.delay:
-        config["SNAG"]["delay"] = args.delay
-    if args.verbose:
-        config["SNAG"]["verbose"] = args.verbose
-    if args.outward_code:
-        config["SNAG"]["outward_code"] = args.outward_code
-    if args.tolerance:
-        config["SNAG"]["tolerance"] = args.tolerance
-    if args.base_host:
-        config["SNAG"]["base_host"] = args.base_host
-    if args.echo_out:
-        config["SNAG"]["echo_out"] = args.echo_out
-
-    verbose: bool = config["SNAG"]["verbose"] == "yes"
-    echo_out: bool = config["SNAG"]["echo_out"] == "yes"
-
-    # If the due_by argument has been given as a numeric value, then convert
-    # to an ISO8601 format time ahead of now. Otherwise, strip trailing Z if
-    # present as datetime.isoformat does not handle it correctly.
-    due_by: str = args.due_by
-    try:
-        time_ahead: float = float(args.due_by)
-        due_by = (datetime.now() + timedelta(hours=time_ahead)).isoformat()
-    except ValueError:
-        due_by = due_by.rstrip("Z")
+    cfg: SnagConfig = SnagConfig.load(config["SNAG"], args)
+
+    # Schedule all the tasks in the file from a single process
+    if args.tasks:
+        tasks: List[SnagTask] = load_tasks(args.tasks, cfg)
+        if not asyncio.run(schedule_tasks(tasks, cfg.verbose)):
+            exit(1)
+        return
 
     # Construct the task object, and start scheduling
     cmd = "".join(args.cmd)
     task = SnagTask(
         cmd=cmd,
-        due_by=due_by,
+        due_by=parse_due_by(args.due_by),
         duration_scheduled=math.ceil(args.duration),
-        base_host=config["SNAG"]["base_host"],
-        outward_code=config["SNAG"]["outward_code"],
-        time_offset=int(config["SNAG"]["delay"]),
-        tolerance=int(config["SNAG"]["tolerance"]),
+        base_host=cfg.base_host,
+        sizzler=cfg.sizzler,
+        outward_code=cfg.outward_code,
+        time_offset=cfg.delay,
+        tolerance=cfg.tolerance,
         working_dir=args.working_dir,
         shell=args.shell,
-        echo_out=echo_out,
+        echo_out=cfg.echo_out,
     )
-    schedule_task(task, first=True, verbose=verbose)
+    schedule_task(task, first=True, verbose=cfg.verbose)
 
     while not task.has_run:
-        sleep_until_next(int(config["SNAG"]["delay"]), verbose)
-        schedule_task(task, verbose=verbose)
-
-    time_now: str = datetime.now().strftime("%Y-%m-%d %H:%M")
-    savings: List[int] = [0] * 3
-
-    for saving, intensity in enumerate(
-        [task.co2_spot, task.co2_worst_known, task.co2_worst_forecast]
-    ):
-        savings[saving] = abs(int(((task.co2_actual / intensity) - 1) * 100))
+        sleep_until_next(cfg.delay, cfg.verbose)
+        schedule_task(task, verbose=cfg.verbose)
 
-    print(f"snag @ {time_now}")
-    print(f"    Task:         {task.cmd}")
-    print(f"    Duration:     {task.duration_actual} @ {task.co2_actual} gCO2/kWh")
-    print("    CO2 saving:")
-    print(f"      - Spot:     {savings[0]}%")
-    print(f"      - Known:    {savings[1]}%")
-    print(f"      - Forecast: {savings[2]}%")
+    report(task)
 
 
 if __name__ == "__main__":
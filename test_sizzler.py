@@ -0,0 +1,285 @@
+import sizzler
+import snag
+
+import datetime
+import http.client
+import itertools
+import json
+import threading
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+
+class FakeUpstream:
+    """Stands in for the NG API, counting requests and optionally blocking them"""
+
+    def __init__(self, response=(200, b'{"data": []}')):
+        self.response = response
+        self.calls = 0
+        self.paths = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def request(self, path):
+        self.calls += 1
+        self.paths.append(path)
+        self.started.set()
+        self.release.wait(5)
+        response = self.response(path) if callable(self.response) else self.response
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def regional_payload(times, regionids=(1, 2)):
+    """Response to /regional/intensity/<from>/fw48h, for each consecutive pair of times"""
+    return json.dumps(
+        {
+            "data": [
+                {
+                    "from": tm_from,
+                    "to": tm_to,
+                    "regions": [
+                        {
+                            "regionid": regionid,
+                            "dnoregion": f"DNO {regionid}",
+                            "shortname": f"Region {regionid}",
+                            "intensity": {"forecast": 100 * regionid + idx},
+                            "generationmix": [],
+                        }
+                        for regionid in regionids
+                    ],
+                }
+                for idx, (tm_from, tm_to) in enumerate(zip(times, times[1:]))
+            ]
+        }
+    ).encode()
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = sizzler.ConnectionPool("example.com")
+        self.stale = mock.Mock()
+        self.pool.idle.put_nowait(self.stale)
+        patcher = mock.patch("http.client.HTTPSConnection")
+        self.connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        response = self.connection.return_value.getresponse.return_value
+        response.status = 200
+        response.read.return_value = b"{}"
+
+    def test_retry_closed_connection(self):
+        self.stale.request.side_effect = http.client.RemoteDisconnected()
+        self.assertEqual(self.pool.request("/"), (200, b"{}"))
+        self.connection.assert_called_once()
+
+    def test_no_retry_on_timeout(self):
+        self.stale.request.side_effect = TimeoutError()
+        with self.assertRaises(TimeoutError):
+            self.pool.request("/")
+        self.connection.assert_not_called()
+
+
+class SizzlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.upstream = FakeUpstream()
+
+        # Handlers share their cache as class attributes, so each test gets a
+        # subclass with its own
+        class TestSizzler(sizzler.Sizzler):
+            cache = OrderedDict()
+            request_count = itertools.count()
+            inflight = {}
+            backoff = {}
+            upstream = self.upstream
+
+        self.handler_class = TestSizzler
+        self.handler = TestSizzler.__new__(TestSizzler)
+        patcher = mock.patch("sizzler.print", create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refresh(self, cache_key="0"):
+        self.handler.refresh(
+            cache_key,
+            cache_key,
+            lambda: self.handler.update_entry(cache_key, "/intensity/T/fw48h"),
+        )
+
+
+class TestRefresh(SizzlerTestCase):
+    def test_single_flight(self):
+        self.upstream.release.clear()
+        threads = [threading.Thread(target=self.refresh) for _ in range(8)]
+        threads[0].start()
+        self.assertTrue(self.upstream.started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        self.upstream.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.upstream.calls, 1)
+        self.assertIn("0", self.handler.cache)
+
+    def test_fresh_entry_not_refetched(self):
+        self.refresh()
+        self.refresh()
+        self.assertEqual(self.upstream.calls, 1)
+
+
+class TestUpdateRegional(SizzlerTestCase):
+    def test_update_regional(self):
+        start = snag.half_hour_floor(datetime.datetime.now())
+        times = [
+            (start + datetime.timedelta(minutes=30 * i)).strftime("%Y-%m-%dT%H:%MZ")
+            for i in range(1, 4)
+        ]
+        self.upstream.response = (200, regional_payload(times))
+        self.assertTrue(self.handler.update_regional(times[0], "1"))
+        self.assertEqual(self.upstream.calls, 1)
+        self.assertEqual(set(self.handler.cache), {"1", "2"})
+
+        for regionid in (1, 2):
+            with self.subTest(regionid=regionid):
+                data = json.loads(self.handler.cache[str(regionid)].body)
+                self.assertEqual(data["data"]["shortname"], f"Region {regionid}")
+                expected = [
+                    (
+                        tm.rstrip("Z"),
+                        100 * regionid + idx,
+                        snag.half_hour_slot(datetime.datetime.fromisoformat(tm.rstrip("Z"))),
+                    )
+                    for idx, tm in enumerate(times[:2])
+                ]
+                result = snag.decompose_fw48(data, snag.ForecastSource.REGIONAL)
+                self.assertEqual(result, expected)
+
+
+class SizzlerServerTestCase(SizzlerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.handler_class.log_message = lambda *args: None
+        server = sizzler.SizzlerServer(("127.0.0.1", 0), self.handler_class, threads=2)
+        thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.port = server.server_address[1]
+        slot = self.handler.time_slot()
+        self.now = datetime.datetime.fromtimestamp(slot * 1800, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%MZ")
+
+    def get(self, path):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=5)
+        self.addCleanup(conn.close)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+
+class TestRegionalRequests(SizzlerServerTestCase):
+    def test_current_slot_batched(self):
+        self.upstream.response = (200, regional_payload([self.now, self.now], regionids=range(1, 18)))
+        self.assertEqual(self.get(f"/regional/intensity/{self.now}/fw48h/regionid/3")[0], 200)
+        self.assertEqual(self.get(f"/regional/intensity/{self.now}/fw48h/regionid/5")[0], 200)
+        self.assertEqual(self.upstream.paths, [f"/regional/intensity/{self.now}/fw48h"])
+        self.assertEqual(len(self.handler.cache), 17)
+
+    def test_other_time_not_batched(self):
+        for time_from in ("2020-01-01T00:00Z", "garbage"):
+            with self.subTest(time_from=time_from):
+                self.handler.cache.clear()
+                self.upstream.paths.clear()
+                path = f"/regional/intensity/{time_from}/fw48h/regionid/3"
+                self.assertEqual(self.get(path)[0], 200)
+                self.assertEqual(self.upstream.paths, [path])
+                self.assertEqual(list(self.handler.cache), ["3"])
+
+
+class TestClientErrors(SizzlerServerTestCase):
+    def test_postcode_client_error_cached(self):
+        self.upstream.response = (400, b'{"error": "bad postcode"}')
+        path = f"/regional/intensity/{self.now}/fw48h/postcode/XX1"
+        for _ in range(2):
+            self.assertEqual(self.get(path), (400, b'{"error": "bad postcode"}'))
+        self.assertEqual(self.upstream.calls, 1)
+        self.assertEqual(self.handler.backoff, {})
+
+    def test_regional_client_error_cached(self):
+        for time_from in ("garbage", self.now):
+            with self.subTest(time_from=time_from):
+                self.handler.cache.clear()
+                self.upstream.response = (400, b'{"error": "bad request"}')
+                path = f"/regional/intensity/{time_from}/fw48h/regionid/3"
+                self.assertEqual(self.get(path), (400, b'{"error": "bad request"}'))
+                self.assertEqual(list(self.handler.cache), ["3"])
+                self.assertEqual(self.handler.backoff, {})
+
+                # Other regions are not held back by the error
+                self.upstream.response = (200, regional_payload([self.now, self.now], regionids=range(1, 18)))
+                self.assertEqual(self.get(f"/regional/intensity/{self.now}/fw48h/regionid/5")[0], 200)
+
+
+class TestCacheBounds(SizzlerTestCase):
+    def test_lru_eviction(self):
+        self.handler.MAX_ENTRIES = 2
+        slot = self.handler.time_slot()
+        self.handler.store({"a": sizzler.CacheEntry.create(slot, b"a")})
+        self.handler.store({"b": sizzler.CacheEntry.create(slot, b"b")})
+        self.handler.touch("a")
+        self.handler.store({"c": sizzler.CacheEntry.create(slot, b"c")})
+        self.assertEqual(list(self.handler.cache), ["a", "c"])
+
+    def test_prune(self):
+        slot = self.handler.time_slot()
+        self.handler.store(
+            {
+                "old": sizzler.CacheEntry.create(slot - self.handler.MAX_AGE_SLOTS - 1, b""),
+                "kept": sizzler.CacheEntry.create(slot - self.handler.MAX_AGE_SLOTS, b""),
+                "new": sizzler.CacheEntry.create(slot, b""),
+            }
+        )
+        self.handler.prune()
+        self.assertEqual(list(self.handler.cache), ["kept", "new"])
+
+
+class TestBackoff(SizzlerTestCase):
+    def test_backoff(self):
+        self.upstream.response = TimeoutError()
+        self.refresh()
+        self.assertEqual(self.handler.backoff["0"][1], 1.0)
+
+        # Not retried until the delay has passed
+        self.refresh()
+        self.assertEqual(self.upstream.calls, 1)
+
+        for last_delay, expected in ((1.0, 2.0), (2.0, 4.0), (40.0, 60.0), (60.0, 60.0)):
+            with self.subTest(last_delay=last_delay):
+                self.handler.backoff["0"] = (0.0, last_delay)
+                self.refresh()
+                self.assertEqual(self.handler.backoff["0"][1], expected)
+
+    def test_server_error(self):
+        self.upstream.response = (503, b"")
+        self.refresh()
+        self.assertIn("0", self.handler.backoff)
+        self.assertNotIn("0", self.handler.cache)
+
+    def test_serve_stale(self):
+        stale = sizzler.CacheEntry.create(self.handler.time_slot() - 1, b"stale")
+        self.handler.store({"0": stale})
+        self.upstream.response = TimeoutError()
+        self.refresh()
+        self.assertIs(self.handler.cache["0"], stale)
+
+    def test_success_clears_backoff(self):
+        self.handler.backoff["0"] = (0.0, 4.0)
+        self.refresh()
+        self.assertEqual(self.handler.backoff, {})
+        self.assertIn("0", self.handler.cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,14 @@
 import snag
 
+import argparse
+import asyncio
+import configparser
 import datetime
+import http.client
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 
 class TestDateTimeFunctions(unittest.TestCase):
@@ -37,6 +44,214 @@ class TestDateTimeFunctions(unittest.TestCase):
                 result = snag.half_hour_ceil(dt)
                 self.assertEqual(result, expected)
 
+    def test_half_hour_slot(self):
+        test_cases = (
+            (datetime.datetime(1970, 1, 1, 0, 0, 0), 0),
+            (datetime.datetime(1970, 1, 1, 0, 29, 59), 0),
+            (datetime.datetime(1970, 1, 1, 0, 30, 0), 1),
+            (datetime.datetime(2023, 4, 25, 11, 0, 0), 934678),
+            (datetime.datetime(2023, 4, 25, 11, 46, 0), 934679),
+        )
+        for dt, expected in test_cases:
+            with self.subTest(dt=dt):
+                result = snag.half_hour_slot(dt)
+                self.assertEqual(result, expected)
+
+
+class TestWeightTimepoints(unittest.TestCase):
+    def test_weight_timepoints(self):
+        test_cases = (
+            (70, 0, [100, 200, 300, 400, 500], [171, 271, 300, 400, 500]),
+            (40, 10, [100, 200, 300], [150, 200, 300]),
+            (60, 0, [90, 30, 60, 120], [60, 30, 60, 120]),
+        )
+        for duration, offset, intensities, expected in test_cases:
+            with self.subTest(duration=duration, offset=offset):
+                task = snag.SnagTask(
+                    cmd="true",
+                    due_by="2023-04-25T12:00",
+                    duration_scheduled=duration,
+                    time_offset=offset,
+                )
+                timepoints = [(str(idx), i, idx) for idx, i in enumerate(intensities)]
+                snag.weight_timepoints(task, timepoints)
+                self.assertEqual([tp[1] for tp in timepoints], expected)
+                self.assertEqual([tp[0] for tp in timepoints], [str(idx) for idx in range(len(intensities))])
+                self.assertEqual([tp[2] for tp in timepoints], list(range(len(intensities))))
+
+
+class TestQueryApi(unittest.TestCase):
+    def setUp(self):
+        snag.validators.clear()
+        self.addCleanup(snag.validators.clear)
+
+    def fake_fetch(self, status, etag):
+        headers = http.client.HTTPMessage()
+        headers["Content-Type"] = "application/json; charset=utf-8"
+        headers["ETag"] = etag
+        page = mock.Mock(status=status, reason="", headers=headers)
+        return mock.patch("snag.fetch", return_value=(page, b'{"data": []}' if status == 200 else b""))
+
+    def test_revalidate(self):
+        with self.fake_fetch(200, '"a"'):
+            self.assertEqual(snag.query_api("https://example.com/now"), {"data": []})
+        with self.fake_fetch(304, '"a"') as fetch:
+            self.assertEqual(snag.query_api("https://example.com/now"), {"data": []})
+            fetch.assert_called_once_with("https://example.com/now", {"If-None-Match": '"a"'})
+
+    def test_stale_validators_dropped(self):
+        snag.validators["https://example.com/then"] = (0, '"a"', {"data": []})
+        with self.fake_fetch(200, '"b"'):
+            snag.query_api("https://example.com/now")
+        self.assertEqual(list(snag.validators), ["https://example.com/now"])
+
+
+class FakeDatetime(datetime.datetime):
+    times = []
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.times.pop(0)
+
+
+class TestTimeUntilNext(unittest.TestCase):
+    def test_time_until_next(self):
+        test_cases = (
+            # Wake is at 11:30:01; the clock is read before and after computing it
+            ((datetime.datetime(2023, 4, 25, 11, 20, 0), datetime.datetime(2023, 4, 25, 11, 20, 0)), 0, 601.0),
+            ((datetime.datetime(2023, 4, 25, 11, 20, 0), datetime.datetime(2023, 4, 25, 11, 20, 0)), 5, 901.0),
+            # The interval passes between reading the clock twice
+            ((datetime.datetime(2023, 4, 25, 11, 29, 59), datetime.datetime(2023, 4, 25, 11, 30, 2)), 0, 0.0),
+        )
+        for times, offset, expected in test_cases:
+            with self.subTest(times=times, offset=offset):
+                FakeDatetime.times = list(times)
+                with mock.patch("snag.datetime", FakeDatetime):
+                    result = snag.time_until_next(offset)
+                self.assertEqual(result, expected)
+
+
+class TestSnagConfig(unittest.TestCase):
+    def load(self, file_values, **arg_values):
+        config = configparser.ConfigParser()
+        config.read_dict({"SNAG": file_values})
+        args = argparse.Namespace(delay=None, base_host=None, sizzler=False, tolerance=None, outward_code=None, verbose=False, echo_out=False)
+        for key, value in arg_values.items():
+            setattr(args, key, value)
+        return snag.SnagConfig.load(config["SNAG"], args)
+
+    def test_load(self):
+        test_cases = (
+            ({}, {}, {"delay": 0, "tolerance": 5, "outward_code": "0", "verbose": False}),
+            ({"delay": "5", "tolerance": "10", "outward_code": "NW1"}, {}, {"delay": 5, "tolerance": 10, "outward_code": "NW1"}),
+            ({"delay": "5", "outward_code": "NW1"}, {"delay": "15", "outward_code": "SW1"}, {"delay": 15, "outward_code": "SW1"}),
+            ({"verbose": "yes", "sizzler": "on", "echo_out": "true"}, {}, {"verbose": True, "sizzler": True, "echo_out": True}),
+            ({"verbose": "no", "sizzler": "off", "echo_out": "0"}, {}, {"verbose": False, "sizzler": False, "echo_out": False}),
+            ({"verbose": "no"}, {"verbose": True}, {"verbose": True}),
+        )
+        for file_values, arg_values, expected in test_cases:
+            with self.subTest(file_values=file_values, arg_values=arg_values):
+                cfg = self.load(file_values, **arg_values)
+                for key, value in expected.items():
+                    self.assertEqual(getattr(cfg, key), value)
+
+    def test_load_invalid(self):
+        test_cases = (
+            ({"verbose": "y"}, {}, "verbose"),
+            ({"delay": "soon"}, {}, "delay"),
+            ({}, {"tolerance": "lots"}, "tolerance"),
+        )
+        for file_values, arg_values, key in test_cases:
+            with self.subTest(file_values=file_values, arg_values=arg_values):
+                with mock.patch("builtins.print") as print_mock, self.assertRaises(SystemExit):
+                    self.load(file_values, **arg_values)
+                self.assertIn(f"Invalid {key}", print_mock.call_args[0][0])
+
+
+class TestTasks(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        patcher = mock.patch("builtins.print")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_load_tasks(self):
+        path = self.write("tasks.ini", (
+            "[SNAG]\ncmd: ignored\n"
+            "[TASK_a]\ncmd: ./a.sh --flag\ndue_by: 2023-04-25T12:00Z\nduration: 44.5\noutward_code: NW1\n"
+            "[TASK_b]\ncmd: ./b.sh\ndue_by: 2023-04-25T14:00\ndelay: 5\nshell: yes\n"
+        ))
+        cfg = snag.SnagConfig(delay=10, outward_code="3", sizzler=True)
+        tasks = snag.load_tasks(path, cfg)
+        self.assertEqual([task.cmd for task in tasks], ["./a.sh --flag", "./b.sh"])
+        self.assertEqual([task.due_by for task in tasks], ["2023-04-25T11:05", "2023-04-25T13:45"])
+        self.assertEqual([task.duration_scheduled for task in tasks], [45, 10])
+        self.assertEqual([task.outward_code for task in tasks], ["NW1", "3"])
+        self.assertEqual([task.time_offset for task in tasks], [10, 5])
+        self.assertEqual([task.shell for task in tasks], [False, True])
+        self.assertEqual([task.sizzler for task in tasks], [True, True])
+
+    def test_load_tasks_invalid(self):
+        test_cases = (
+            ("missing_cmd.ini", "[TASK_a]\ndue_by: 2023-04-25T12:00\n"),
+            ("bad_duration.ini", "[TASK_a]\ncmd: true\ndue_by: 2023-04-25T12:00\nduration: long\n"),
+            ("no_tasks.ini", "[SNAG]\ndelay: 0\n"),
+            ("not_ini.ini", "cmd: true\n"),
+        )
+        for name, text in test_cases:
+            with self.subTest(name=name):
+                with self.assertRaises(SystemExit):
+                    snag.load_tasks(self.write(name, text), snag.SnagConfig())
+
+    def test_tasks_argument(self):
+        cfg_path = self.write("snag.ini", "[SNAG]\ndelay: 0\n")
+        tasks_path = self.write("tasks.ini", "[TASK_a]\ncmd: true\ndue_by: 2023-04-25T12:00\n")
+        test_cases = (
+            (["--tasks", tasks_path], True, None),
+            (["--tasks", tasks_path], False, 1),
+            (["2023-04-25T12:00", "true"], None, None),
+            ([], None, 2),
+            (["2023-04-25T12:00"], None, 2),
+        )
+        for argv, ran, exit_code in test_cases:
+            with self.subTest(argv=argv, ran=ran):
+                with mock.patch("sys.argv", ["snag", "-c", cfg_path] + argv), \
+                        mock.patch("snag.schedule_tasks", mock.AsyncMock(return_value=ran)) as schedule_tasks, \
+                        mock.patch("snag.schedule_task", side_effect=lambda task, **kwargs: setattr(task, "has_run", True)) as schedule_task, \
+                        mock.patch("snag.report"), \
+                        mock.patch("sys.stderr"):
+                    if exit_code is None:
+                        snag.main()
+                    else:
+                        with self.assertRaises(SystemExit) as cm:
+                            snag.main()
+                        self.assertEqual(cm.exception.code, exit_code)
+                if ran is not None:
+                    self.assertEqual([task.cmd for task in schedule_tasks.call_args[0][0]], ["true"])
+                    schedule_task.assert_not_called()
+                elif exit_code is None:
+                    schedule_tasks.assert_not_called()
+                    schedule_task.assert_called_once()
+
+    def test_failed_task_isolated(self):
+        def schedule_task(task, first, verbose):
+            if task.cmd == "bad":
+                exit(1)
+            task.has_run = True
+
+        tasks = [snag.SnagTask(cmd=cmd, due_by="2023-04-25T12:00") for cmd in ("bad", "good")]
+        with mock.patch("snag.schedule_task", schedule_task), mock.patch("snag.report") as report:
+            self.assertFalse(asyncio.run(snag.schedule_tasks(tasks)))
+        report.assert_called_once_with(tasks[1])
+
 
 if __name__ == '__main__':
     unittest.main()